@@ -1,6 +1,6 @@
 /**
  * Temporal Difference Learning Demo for Game 2048
- * use 'g++ -std=c++0x -O3 -g -o 2048 2048.cpp' to compile the source
+ * use 'g++ -std=c++0x -O3 -g -pthread -o 2048 2048.cpp' to compile the source
  * https://github.com/moporgic/TDL2048-Demo
  *
  * Computer Games and Intelligence (CGI) Lab, NCTU, Taiwan
@@ -26,14 +26,21 @@
 #include <sstream>
 #include <fstream>
 #include <cmath>
+#include <cstdlib>
+#include <cstring>
+#include <random>
+#include <thread>
+#include <sys/mman.h>
 
 /**
  * output streams
- * to enable debugging (more output), just change the line to 'std::ostream& debug = std::cout;'
+ * to enable debugging (more output), just change the line to 'constexpr bool debugging = true;'
+ * debug output should be guarded by 'if (debugging)', so that nothing is formatted when it is disabled
  */
+constexpr bool debugging = false;
 std::ostream& info = std::cout;
 std::ostream& error = std::cerr;
-std::ostream& debug = *(new std::ofstream);
+std::ostream& debug = debugging ? std::cout : *(new std::ofstream);
 
 /**
  * 64-bit bitboard implementation for 2048
@@ -77,6 +84,14 @@ public:
 	 * set a 4-bit tile
 	 */
 	void set(int i, int t) { raw = (raw & ~(0x0fULL << (i << 2))) | (uint64_t(t & 0x0f) << (i << 2)); }
+	/**
+	 * get the largest 4-bit tile
+	 */
+	int  max_tile() const {
+		int tile = 0;
+		for (uint64_t x = raw; x; x >>= 4) tile = std::max(tile, int(x & 0x0f));
+		return tile;
+	}
 
 public:
 	bool operator ==(const board& b) const { return raw == b.raw; }
@@ -89,35 +104,23 @@ public:
 private:
 	/**
 	 * the lookup table for moving board
+	 * left[r], right[r] and score[r] are the results of moving a 16-bit row r
 	 */
 	struct lookup {
-		int raw; // base row (16-bit raw)
-		int left; // left operation
-		int right; // right operation
-		int score; // merge reward
+		uint16_t left[65536]; // left operation
+		uint16_t right[65536]; // right operation
+		int score[65536]; // merge reward
 
 		void init(int r) {
-			raw = r;
-
 			int V[4] = { (r >> 0) & 0x0f, (r >> 4) & 0x0f, (r >> 8) & 0x0f, (r >> 12) & 0x0f };
 			int L[4] = { V[0], V[1], V[2], V[3] };
 			int R[4] = { V[3], V[2], V[1], V[0] }; // mirrored
 
-			score = mvleft(L);
-			left = ((L[0] << 0) | (L[1] << 4) | (L[2] << 8) | (L[3] << 12));
+			score[r] = mvleft(L);
+			left[r] = ((L[0] << 0) | (L[1] << 4) | (L[2] << 8) | (L[3] << 12));
 
-			score = mvleft(R); std::reverse(R, R + 4);
-			right = ((R[0] << 0) | (R[1] << 4) | (R[2] << 8) | (R[3] << 12));
-		}
-
-		void move_left(uint64_t& raw, int& sc, int i) const {
-			raw |= uint64_t(left) << (i << 4);
-			sc += score;
-		}
-
-		void move_right(uint64_t& raw, int& sc, int i) const {
-			raw |= uint64_t(right) << (i << 4);
-			sc += score;
+			score[r] = mvleft(R); std::reverse(R, R + 4);
+			right[r] = ((R[0] << 0) | (R[1] << 4) | (R[2] << 8) | (R[3] << 12));
 		}
 
 		static int mvleft(int row[]) {
@@ -148,36 +151,57 @@ private:
 		}
 
 		lookup() {
-			static int row = 0;
-			init(row++);
+			for (int r = 0; r < 65536; r++) init(r);
 		}
 
-		static const lookup& find(int row) {
-			static const lookup cache[65536];
-			return cache[row];
+		static const lookup& find() {
+			static const lookup cache;
+			return cache;
 		}
 	};
 
+	/**
+	 * move every column as a row, without transposing the board
+	 * column c (tiles c, c+4, c+8, c+12) is gathered into a 16-bit row, moved by the given table, then scattered back
+	 */
+	int move_column(const uint16_t mv[]) {
+		const lookup& t = lookup::find();
+		uint64_t move = 0;
+		int score = 0;
+		for (int c = 0; c < 4; c++) {
+			uint64_t col = (raw >> (c << 2)) & 0x000f000f000f000fULL;
+			int row = (col | (col >> 12) | (col >> 24) | (col >> 36)) & 0xffff;
+			uint64_t res = mv[row];
+			move |= ((res & 0x000f) | ((res & 0x00f0) << 12) | ((res & 0x0f00) << 24) | ((res & 0xf000) << 36)) << (c << 2);
+			score += t.score[row];
+		}
+		uint64_t prev = raw;
+		raw = move;
+		return (move != prev) ? score : -1;
+	}
+
 public:
 
 	/**
 	 * reset to initial state (2 random tile on board)
 	 */
-	void init() { raw = 0; popup(); popup(); }
+	void init(std::mt19937& engine) { raw = 0; popup(engine); popup(engine); }
 
 	/**
 	 * add a new random tile on board, or do nothing if the board is full
 	 * 2-tile: 90%
 	 * 4-tile: 10%
 	 */
-	void popup() {
-		int space[16], num = 0;
-		for (int i = 0; i < 16; i++)
-			if (at(i) == 0) {
-				space[num++] = i;
-			}
-		if (num)
-			set(space[rand() % num], rand() % 10 ? 1 : 2);
+	void popup(std::mt19937& engine) {
+		uint64_t x = raw | (raw >> 1);
+		x |= (x >> 2);
+		uint64_t space = ~x & 0x1111111111111111ULL; // the lowest bit of each empty tile
+		int num = __builtin_popcountll(space);
+		if (num) {
+			for (int k = engine() % num; k; k--)
+				space &= space - 1; // drop the lowest empty tile
+			set(__builtin_ctzll(space) >> 2, engine() % 10 ? 1 : 2);
+		}
 	}
 
 	/**
@@ -195,38 +219,30 @@ public:
 	}
 
 	int move_left() {
-		uint64_t move = 0;
+		const lookup& t = lookup::find();
+		int r0 = fetch(0), r1 = fetch(1), r2 = fetch(2), r3 = fetch(3);
+		uint64_t move = (uint64_t(t.left[r0]) << 0) | (uint64_t(t.left[r1]) << 16)
+		              | (uint64_t(t.left[r2]) << 32) | (uint64_t(t.left[r3]) << 48);
+		int score = t.score[r0] + t.score[r1] + t.score[r2] + t.score[r3];
 		uint64_t prev = raw;
-		int score = 0;
-		lookup::find(fetch(0)).move_left(move, score, 0);
-		lookup::find(fetch(1)).move_left(move, score, 1);
-		lookup::find(fetch(2)).move_left(move, score, 2);
-		lookup::find(fetch(3)).move_left(move, score, 3);
 		raw = move;
 		return (move != prev) ? score : -1;
 	}
 	int move_right() {
-		uint64_t move = 0;
+		const lookup& t = lookup::find();
+		int r0 = fetch(0), r1 = fetch(1), r2 = fetch(2), r3 = fetch(3);
+		uint64_t move = (uint64_t(t.right[r0]) << 0) | (uint64_t(t.right[r1]) << 16)
+		              | (uint64_t(t.right[r2]) << 32) | (uint64_t(t.right[r3]) << 48);
+		int score = t.score[r0] + t.score[r1] + t.score[r2] + t.score[r3];
 		uint64_t prev = raw;
-		int score = 0;
-		lookup::find(fetch(0)).move_right(move, score, 0);
-		lookup::find(fetch(1)).move_right(move, score, 1);
-		lookup::find(fetch(2)).move_right(move, score, 2);
-		lookup::find(fetch(3)).move_right(move, score, 3);
 		raw = move;
 		return (move != prev) ? score : -1;
 	}
 	int move_up() {
-		rotate_right();
-		int score = move_right();
-		rotate_left();
-		return score;
+		return move_column(lookup::find().left);
 	}
 	int move_down() {
-		rotate_right();
-		int score = move_left();
-		rotate_left();
-		return score;
+		return move_column(lookup::find().right);
 	}
 
 	/**
@@ -314,15 +330,19 @@ private:
  */
 class feature {
 public:
-	feature(size_t len) : length(len), weight(alloc(len)) {}
-	feature(feature&& f) : length(f.length), weight(f.weight) { f.weight = nullptr; }
+	feature(size_t len) : length(len), weight(alloc<float>(len)), compact(alloc<uint16_t>(len)) {}
+	feature(feature&& f) : length(f.length), weight(f.weight), compact(f.compact) { f.weight = nullptr; f.compact = nullptr; }
 	feature(const feature& f) = delete;
 	feature& operator =(const feature& f) = delete;
-	virtual ~feature() { delete[] weight; }
+	virtual ~feature() { release(weight, length); release(compact, length); }
 
-	float& operator[] (size_t i) { return weight[i]; }
 	float operator[] (size_t i) const { return weight[i]; }
+	void set(size_t i, float v) { weight[i] = v; sync(i); }
 	size_t size() const { return length; }
+	/**
+	 * memory usage in bytes, including the bfloat16 mirror of the weight table
+	 */
+	size_t usage() const { return length * (sizeof(float) + sizeof(uint16_t)); }
 
 public: // should be implemented
 
@@ -341,6 +361,16 @@ public: // should be implemented
 
 public:
 
+	/**
+	 * estimate the values of n given boards, and accumulate them into value[0] to value[n - 1]
+	 * override this to overlap the weight lookups of different boards
+	 */
+	virtual void estimate(const board b[], float value[], size_t n) const {
+		for (size_t i = 0; i < n; i++) {
+			value[i] += estimate(b[i]);
+		}
+	}
+
 	/**
 	 * dump the detail of weight table of a given board
 	 */
@@ -383,25 +413,62 @@ public:
 			error << "unexpected end of binary" << std::endl;
 			std::exit(1);
 		}
+		for (size_t i = 0; i < size; i++) w.sync(i);
 		return in;
 	}
 
 protected:
-	static float* alloc(size_t num) {
+
+	/**
+	 * the weight table is mirrored in bfloat16 (the upper 16 bits of a float) for estimating,
+	 * which halves the memory traffic of lookups; the float table is still the master copy for learning
+	 * use set(i, v), or call sync(i) after modifying weight[i] directly
+	 */
+	float approx(size_t i) const {
+		uint32_t bits = uint32_t(compact[i]) << 16;
+		float value;
+		std::memcpy(&value, &bits, sizeof(float));
+		return value;
+	}
+	void sync(size_t i) {
+		uint32_t bits;
+		std::memcpy(&bits, &weight[i], sizeof(float));
+		compact[i] = (bits + 0x7fff + ((bits >> 16) & 1)) >> 16; // round to nearest even
+	}
+
+	/**
+	 * allocate a zero-initialized table by anonymous memory mapping
+	 * the pages are only backed by physical memory after being touched
+	 */
+	template<typename T>
+	static T* alloc(size_t num) {
+		return static_cast<T*>(alloc_bytes(sizeof(T) * num));
+	}
+	/**
+	 * all tables (of any type) share the same 1G memory limit
+	 */
+	static void* alloc_bytes(size_t bytes) {
 		static size_t total = 0;
-		static size_t limit = (1 << 30) / sizeof(float); // 1G memory
+		static size_t limit = (1 << 30); // 1G memory
 		try {
-			total += num;
+			total += bytes;
 			if (total > limit) throw std::bad_alloc();
-			return new float[num]();
+			void* mem = mmap(nullptr, bytes, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+			if (mem == MAP_FAILED) throw std::bad_alloc();
+			return mem;
 		} catch (std::bad_alloc&) {
 			error << "memory limit exceeded" << std::endl;
 			std::exit(-1);
 		}
 		return nullptr;
 	}
+	template<typename T>
+	static void release(T* table, size_t num) {
+		if (table) munmap(table, sizeof(T) * num);
+	}
 	size_t length;
 	float* weight;
+	uint16_t* compact;
 };
 
 /**
@@ -420,12 +487,7 @@ protected:
  */
 class pattern : public feature {
 public:
-	pattern(const std::vector<int>& p, int iso = 8) : feature(1 << (p.size() * 4)), iso_last(iso) {
-		if (p.empty()) {
-			error << "no pattern defined" << std::endl;
-			std::exit(1);
-		}
-
+	pattern(const std::vector<int>& p, int iso = 8) : feature(sizeof_table(p)), iso_last(iso) {
 		/**
 		 * isomorphic patterns can be calculated by board
 		 *
@@ -452,6 +514,17 @@ public:
 				isomorphic[i].push_back(idx.at(t));
 			}
 		}
+
+		/**
+		 * pack each isomorphic pattern into a 64-bit value of bit offsets
+		 * the j-th byte of isomorphic_packed[i] is the bit offset of the j-th tile of the i-th isomorphic pattern
+		 */
+		for (int i = 0; i < 8; i++) {
+			isomorphic_packed[i] = 0;
+			for (size_t j = 0; j < isomorphic[i].size(); j++) {
+				isomorphic_packed[i] |= uint64_t(isomorphic[i][j] << 2) << (j << 3);
+			}
+		}
 	}
 	pattern(const pattern& p) = delete;
 	virtual ~pattern() {}
@@ -463,24 +536,49 @@ public:
 	 * estimate the value of a given board
 	 */
 	virtual float estimate(const board& b) const {
+		size_t index[8];
+		indexof(b, index);
 		float value = 0;
 		for (int i = 0; i < iso_last; i++) {
-			size_t index = indexof(isomorphic[i], b);
-			value += operator[](index);
+			value += approx(index[i]);
 		}
 		return value;
 	}
 
+	/**
+	 * estimate the values of n given boards, and accumulate them into value[0] to value[n - 1]
+	 * the indexes of up to 4 boards are calculated before any weight is read, so that their lookups can overlap
+	 */
+	virtual void estimate(const board b[], float value[], size_t n) const {
+		for (size_t k = 0; k < n; k += 4) {
+			size_t num = std::min(n - k, size_t(4));
+			size_t index[4][8];
+			for (size_t i = 0; i < num; i++) {
+				indexof(b[k + i], index[i]);
+			}
+			for (size_t i = 0; i < num; i++) {
+				float v = 0;
+				for (int j = 0; j < iso_last; j++) {
+					v += approx(index[i][j]);
+				}
+				value[k + i] += v;
+			}
+		}
+	}
+
 	/**
 	 * update the value of a given board, and return its updated value
 	 */
 	virtual float update(const board& b, float u) {
 		float u_split = u / iso_last;
+		size_t index[8];
+		indexof(b, index);
 		float value = 0;
 		for (int i = 0; i < iso_last; i++) {
-			size_t index = indexof(isomorphic[i], b);
-			operator[](index) += u_split;
-			value += operator[](index);
+			float& w = weight[index[i]];
+			w += u_split;
+			sync(index[i]);
+			value += w;
 		}
 		return value;
 	}
@@ -508,7 +606,7 @@ public:
 	void dump(const board& b, std::ostream& out = info) const {
 		for (int i = 0; i < iso_last; i++) {
 			out << "#" << i << ":" << nameof(isomorphic[i]) << "(";
-			size_t index = indexof(isomorphic[i], b);
+			size_t index = indexof(i, b);
 			for (size_t i = 0; i < isomorphic[i].size(); i++) {
 				out << std::hex << ((index >> (4 * i)) & 0x0f);
 			}
@@ -518,13 +616,63 @@ public:
 
 protected:
 
-	size_t indexof(const std::vector<int>& patt, const board& b) const {
+	/**
+	 * get the weight table size of a given pattern, which is checked before the table is allocated
+	 * a pattern should have 1 to 7 tiles, so that its size and indexes fit in 32 bits
+	 */
+	static size_t sizeof_table(const std::vector<int>& p) {
+		if (p.empty()) {
+			error << "no pattern defined" << std::endl;
+			std::exit(1);
+		}
+		if (p.size() >= 8) {
+			error << "pattern is too long" << std::endl;
+			std::exit(1);
+		}
+		return size_t(1) << (p.size() * 4);
+	}
+
+	/**
+	 * get the index of the i-th isomorphic pattern of a given board
+	 */
+	size_t indexof(int i, const board& b) const {
+		uint64_t raw = b;
+		size_t len = isomorphic[0].size();
+		uint64_t shift = isomorphic_packed[i];
 		size_t index = 0;
-		for (size_t i = 0; i < patt.size(); i++)
-			index |= b.at(patt[i]) << (4 * i);
+		for (size_t j = 0; j < len; j++, shift >>= 8)
+			index |= ((raw >> (shift & 0xff)) & 0x0f) << (4 * j);
 		return index;
 	}
 
+	/**
+	 * get the indexes of all enabled isomorphic patterns of a given board in one pass
+	 * common pattern lengths are dispatched to specialized versions whose inner loop is fully unrolled
+	 */
+	void indexof(const board& b, size_t index[]) const {
+		switch (isomorphic[0].size()) {
+		case 4: indexof<4>(b, index); break;
+		case 5: indexof<5>(b, index); break;
+		case 6: indexof<6>(b, index); break;
+		default: indexof<0>(b, index); break;
+		}
+	}
+
+	/**
+	 * get the indexes of all enabled isomorphic patterns for patterns of length N (0 for any length)
+	 */
+	template<size_t N>
+	void indexof(const board& b, size_t index[]) const {
+		uint64_t raw = b;
+		size_t len = N ? N : isomorphic[0].size();
+		for (int i = 0; i < iso_last; i++) {
+			uint64_t shift = isomorphic_packed[i];
+			index[i] = 0;
+			for (size_t j = 0; j < len; j++, shift >>= 8)
+				index[i] |= ((raw >> (shift & 0xff)) & 0x0f) << (4 * j);
+		}
+	}
+
 	std::string nameof(const std::vector<int>& patt) const {
 		std::stringstream ss;
 		ss << std::hex;
@@ -533,6 +681,7 @@ protected:
 	}
 
 	std::array<std::vector<int>, 8> isomorphic;
+	std::array<uint64_t, 8> isomorphic_packed;
 	int iso_last;
 };
 
@@ -549,8 +698,8 @@ public:
 	state& operator =(const state& st) = default;
 
 public:
-	board after_state() const { return after; }
-	board before_state() const { return before; }
+	const board& after_state() const { return after; }
+	const board& before_state() const { return before; }
 	float value() const { return esti; }
 	int reward() const { return score; }
 	int action() const { return opcode; }
@@ -581,7 +730,7 @@ public:
 	 * return true if the action is valid for the given state
 	 */
 	bool assign(const board& b) {
-		debug << "assign " << name() << std::endl << b;
+		if (debugging) debug << "assign " << name() << std::endl << b;
 		after = before = b;
 		score = after.move(opcode);
 		esti = score;
@@ -600,7 +749,7 @@ public:
 			error << "numeric exception" << std::endl;
 			std::exit(1);
 		}
-		return after != before && opcode != -1 && score != -1;
+		return opcode != -1 && score != -1 && after != before;
 	}
 
 	const char* name() const {
@@ -625,6 +774,37 @@ private:
 	float esti;
 };
 
+/**
+ * the trajectory of an episode, i.e., the after states and rewards of all moves
+ * stored as separated arrays since TD(0) only needs these two fields
+ */
+class trajectory {
+public:
+	trajectory() {}
+	trajectory(const trajectory& t) = default;
+	trajectory& operator =(const trajectory& t) = default;
+
+public:
+	const board& after_state(size_t i) const { return after[i]; }
+	int reward(size_t i) const { return score[i]; }
+	size_t size() const { return after.size(); }
+
+	/**
+	 * append a move, which should be a valid state
+	 */
+	void push_back(const state& move) {
+		after.push_back(move.after_state());
+		score.push_back(move.reward());
+	}
+
+	void reserve(size_t n) { after.reserve(n); score.reserve(n); }
+	void clear() { after.clear(); score.clear(); }
+
+private:
+	std::vector<board> after;
+	std::vector<int> score;
+};
+
 class learning {
 public:
 	learning() {}
@@ -640,7 +820,7 @@ public:
 		feats.push_back(feat);
 
 		info << feat->name() << ", size = " << feat->size();
-		size_t usage = feat->size() * sizeof(float);
+		size_t usage = feat->usage();
 		if (usage >= (1 << 30)) {
 			info << " (" << (usage >> 30) << "GB)";
 		} else if (usage >= (1 << 20)) {
@@ -655,7 +835,7 @@ public:
 	 * accumulate the total value of given state
 	 */
 	float estimate(const board& b) const {
-		debug << "estimate " << std::endl << b;
+		if (debugging) debug << "estimate " << std::endl << b;
 		float value = 0;
 		for (feature* feat : feats) {
 			value += feat->estimate(b);
@@ -663,11 +843,21 @@ public:
 		return value;
 	}
 
+	/**
+	 * accumulate the total values of n given states into value[0] to value[n - 1]
+	 */
+	void estimate(const board b[], float value[], size_t n) const {
+		std::fill(value, value + n, 0.0f);
+		for (feature* feat : feats) {
+			feat->estimate(b, value, n);
+		}
+	}
+
 	/**
 	 * update the value of given state and return its new value
 	 */
 	float update(const board& b, float u) const {
-		debug << "update " << " (" << u << ")" << std::endl << b;
+		if (debugging) debug << "update " << " (" << u << ")" << std::endl << b;
 		float u_split = u / feats.size();
 		float value = 0;
 		for (feature* feat : feats) {
@@ -689,42 +879,91 @@ public:
 	 * you may simply return state() if no valid move
 	 */
 	state select_best_move(const board& b) const {
-		state after[4] = { 0, 1, 2, 3 }; // up, right, down, left
-		state* best = after;
-		for (state* move = after; move != after + 4; move++) {
-			if (move->assign(b)) {
-				move->set_value(move->reward() + estimate(move->after_state()));
-				if (move->value() > best->value())
-					best = move;
+		// collect all valid moves first, then estimate their after states together
+		board after[4];
+		int opcode[4], reward[4], num = 0;
+		for (int op = 0; op < 4; op++) { // up, right, down, left
+			after[num] = b;
+			reward[num] = after[num].move(op);
+			if (reward[num] == -1) continue;
+			opcode[num++] = op;
+		}
+		float value[4];
+		estimate(after, value, num);
+
+		int best_op = -1;
+		int best_reward = -1;
+		float best_value = -std::numeric_limits<float>::max();
+		board best_after = b;
+		for (int i = 0; i < num; i++) {
+			value[i] += reward[i];
+			if (debugging) debug << "test " << opcode[i] << ", reward = " << reward[i] << ", value = " << value[i] << std::endl << after[i];
+			if (best_op == -1 || value[i] > best_value) {
+				best_op = opcode[i];
+				best_reward = reward[i];
+				best_value = value[i];
+				best_after = after[i];
+			}
+		}
+
+		state best(best_op);
+		best.set_before_state(b);
+		best.set_after_state(best_after);
+		best.set_reward(best_reward);
+		best.set_value(best_value);
+		return best;
+	}
+
+	/**
+	 * play an episode from a new initial board
+	 *
+	 * the random tiles of this episode are generated from the given seed
+	 * the moves of this episode are appended to path (see update_episode)
+	 * b becomes the terminal board, and the total reward of this episode is returned
+	 */
+	int play_episode(board& b, trajectory& path, unsigned seed) const {
+		std::mt19937 engine(seed);
+		int score = 0;
+		if (debugging) debug << "begin episode" << std::endl;
+		b.init(engine);
+		while (true) {
+			if (debugging) debug << "state" << std::endl << b;
+			state best = select_best_move(b);
+
+			if (best.is_valid()) {
+				if (debugging) debug << "best " << best;
+				path.push_back(best);
+				score += best.reward();
+				b = best.after_state();
+				b.popup(engine);
 			} else {
-				move->set_value(-std::numeric_limits<float>::max());
+				break;
 			}
-			debug << "test " << *move;
 		}
-		return *best;
+		if (debugging) debug << "end episode" << std::endl;
+		return score;
 	}
 
 	/**
 	 * update the tuple network by an episode
 	 *
-	 * path is the sequence of states in this episode,
-	 * the last entry in path (path.back()) is the final state
+	 * path is the sequence of moves in this episode, the terminal state is not included
 	 *
 	 * for example, a 2048 games consists of
 	 *  (initial) s0 --(a0,r0)--> s0' --(popup)--> s1 --(a1,r1)--> s1' --(popup)--> s2 (terminal)
 	 *  where sx is before state, sx' is after state
 	 *
 	 * its path would be
-	 *  { (s0,s0',a0,r0), (s1,s1',a1,r1), (s2,s2,x,-1) }
-	 *  where (x,x,x,x) means (before state, after state, action, reward)
+	 *  { (s0',r0), (s1',r1) }
+	 *  where (x,x) means (after state, reward)
 	 */
-	void update_episode(std::vector<state>& path, float alpha = 0.1) const {
+	void update_episode(const trajectory& path, float alpha = 0.1) const {
 		float exact = 0;
-		for (path.pop_back() /* terminal state */; path.size(); path.pop_back()) {
-			state& move = path.back();
-			float error = exact - (move.value() - move.reward());
-			debug << "update error = " << error << " for after state" << std::endl << move.after_state();
-			exact = move.reward() + update(move.after_state(), alpha * error);
+		for (size_t i = path.size(); i > 0; i--) {
+			const board& after = path.after_state(i - 1);
+			float error = exact - estimate(after); // the value may have changed since the move was selected
+			if (debugging) debug << "update error = " << error << " for after state" << std::endl << after;
+			exact = path.reward(i - 1) + update(after, alpha * error);
 		}
 	}
 
@@ -749,10 +988,7 @@ public:
 	 */
 	void make_statistic(size_t n, const board& b, int score, int unit = 1000) {
 		scores.push_back(score);
-		maxtile.push_back(0);
-		for (int i = 0; i < 16; i++) {
-			maxtile.back() = std::max(maxtile.back(), b.at(i));
-		}
+		maxtile.push_back(b.max_tile());
 
 		if (n % unit == 0) { // show the training process
 			if (scores.size() != size_t(unit) || maxtile.size() != size_t(unit)) {
@@ -762,8 +998,8 @@ public:
 			int sum = std::accumulate(scores.begin(), scores.end(), 0);
 			int max = *std::max_element(scores.begin(), scores.end());
 			int stat[16] = { 0 };
-			for (int i = 0; i < 16; i++) {
-				stat[i] = std::count(maxtile.begin(), maxtile.end(), i);
+			for (int tile : maxtile) {
+				stat[tile]++;
 			}
 			float mean = float(sum) / unit;
 			float coef = 100.0 / unit;
@@ -836,7 +1072,7 @@ public:
 private:
 	std::vector<feature*> feats;
 	std::vector<int> scores;
-	std::vector<int> maxtile;
+	std::vector<uint8_t> maxtile;
 };
 
 int main(int argc, const char* argv[]) {
@@ -846,10 +1082,12 @@ int main(int argc, const char* argv[]) {
 	// set the learning parameters
 	float alpha = 0.1;
 	size_t total = 100000;
+	size_t batch = 4; // episodes played in parallel with the same weights, see below
 	unsigned seed;
 	__asm__ __volatile__ ("rdtsc" : "=a" (seed));
 	info << "alpha = " << alpha << std::endl;
 	info << "total = " << total << std::endl;
+	info << "batch = " << batch << std::endl;
 	info << "seed = " << seed << std::endl;
 	std::srand(seed);
 
@@ -863,35 +1101,33 @@ int main(int argc, const char* argv[]) {
 	tdl.load("");
 
 	// train the model
-	std::vector<state> path;
-	path.reserve(20000);
-	for (size_t n = 1; n <= total; n++) {
-		board b;
-		int score = 0;
-
-		// play an episode
-		debug << "begin episode" << std::endl;
-		b.init();
-		while (true) {
-			debug << "state" << std::endl << b;
-			state best = tdl.select_best_move(b);
-			path.push_back(best);
-
-			if (best.is_valid()) {
-				debug << "best " << best;
-				score += best.reward();
-				b = best.after_state();
-				b.popup();
-			} else {
-				break;
-			}
+	std::vector<trajectory> path(batch);
+	std::vector<board> b(batch);
+	std::vector<int> score(batch);
+	std::vector<unsigned> seeds(batch);
+	for (trajectory& p : path) p.reserve(20000);
+	for (size_t n = 1; n <= total; n += batch) {
+		size_t num = std::min(batch, total - n + 1);
+
+		// play a batch of episodes in parallel, the weight tables are only read here
+		// note that batch is intentionally fixed (at most 4 threads) rather than scaled to the host,
+		// since it also decides how stale the weights are, and thus changes the training dynamics
+		// starting a thread per episode costs far less than playing the episode, so no thread pool is kept
+		for (size_t i = 0; i < num; i++) {
+			seeds[i] = std::rand();
 		}
-		debug << "end episode" << std::endl;
+		std::vector<std::thread> workers;
+		for (size_t i = 0; i < num; i++) {
+			workers.emplace_back([&, i]() { score[i] = tdl.play_episode(b[i], path[i], seeds[i]); });
+		}
+		for (std::thread& worker : workers) worker.join();
 
 		// update by TD(0)
-		tdl.update_episode(path, alpha);
-		tdl.make_statistic(n, b, score);
-		path.clear();
+		for (size_t i = 0; i < num; i++) {
+			tdl.update_episode(path[i], alpha);
+			tdl.make_statistic(n + i, b[i], score[i]);
+			path[i].clear();
+		}
 	}
 
 	// store the model into file